@@ -2,31 +2,82 @@ import yaml
 import os
 import sys
 import logging
-import glob
-from shutil import copyfile, rmtree, unpack_archive
-from distutils.spawn import find_executable
+import re
+import fnmatch
+import ctypes
+import stat
+from shutil import copyfile, copyfileobj, rmtree, which
+import functools
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 logging.basicConfig(format='%(levelname)7s %(message)s', level=10)
 
+# use the libyaml parser when available, the configs only hold plain scalars, lists and dicts
 try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
+if sys.version_info[0] < 3:
     # for python 2
-    input = raw_input
-except NameError:
+    input = raw_input  # noqa: F821
+else:
     # for python 3
     basestring = (str, bytes)
 
 
+def _compile_patterns(patterns):
+    # single regex for a list of glob patterns, so each folder is filtered in one pass
+    # same rules as glob: hidden files are only matched by patterns starting with a dot
+    regex = '|'.join('(?:{0}{1})'.format('' if p.startswith('.') else r'(?!\.)', fnmatch.translate(p)) for p in patterns)
+    # an empty list should not match anything
+    return re.compile(regex or '(?!)', re.IGNORECASE if os.path.normcase('A') == 'a' else 0)
+
+
+_ALL_FILES = _compile_patterns(['*'])
+
+
+if os.name == 'nt':
+    # use_last_error keeps the error code of the failing call, whatever ctypes does afterwards
+    _kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    _kernel32.GetFileAttributesW.restype = ctypes.c_uint32
+    _FILE_ATTRIBUTE_READONLY = 0x1
+    _INVALID_FILE_ATTRIBUTES = 0xFFFFFFFF
+
+
+def _copy_file(source, destination):
+    # on Windows let the kernel do the copy (no userspace buffer, no extra open/stat)
+    if os.name == 'nt':
+        if not _kernel32.CopyFileExW(source, destination, None, None, None, 0):
+            raise ctypes.WinError(ctypes.get_last_error())
+        # CopyFileExW also copies the attributes, and a read-only copy would stop rmtree from cleaning the next build
+        attributes = _kernel32.GetFileAttributesW(destination)
+        if attributes != _INVALID_FILE_ATTRIBUTES and attributes & _FILE_ATTRIBUTE_READONLY:
+            if not _kernel32.SetFileAttributesW(destination, attributes & ~_FILE_ATTRIBUTE_READONLY):
+                raise ctypes.WinError(ctypes.get_last_error())
+    else:
+        copyfile(source, destination)
+
+
+# rmtree error handler clearing the read-only flag, e.g. on files left by builds that copied it
+def _remove_readonly(func, path, exc_info):
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
+
+
 class Builder():
-    supported_tags = ['name', 'version', 'include_data', 'exclude_data', 'remap_folders', 'ArcGIS_support', 'QGIS_support', 'Python_embedded', 'build_folder', 'Python_version', 'installer_script', 'splash_screen']
+    supported_tags = ['name', 'version', 'include_data', 'exclude_data', 'remap_folders', 'ArcGIS_support', 'QGIS_support', 'Python_embedded', 'build_folder', 'Python_version', 'installer_script', 'splash_screen', 'sign']
     runtime_dir = False
     root_dir = False
     target_dir = False
     build_dir = False
+    _config_template = None
+    _cert_paths = None
 
     def __init__(self):
 
-        if find_executable('7z.exe') is None:
-            raise RuntimeError('Could not find the 7zip executable. Please install 7zip before trying again, or add it to your PATH if already installed')
+        # make sure 7zip is available before doing anything
+        self._tool('7z.exe')
 
         self.read_options()
 
@@ -46,47 +97,63 @@ class Builder():
             self.build_dir = os.path.join(self.runtime_dir, 'Build')
         logging.info('  Build folder: {0}'.format(self.build_dir))
         if os.path.isdir(self.build_dir):
-            rmtree(self.build_dir)
+            rmtree(self.build_dir, onerror=_remove_readonly)
         self.target_dir = os.path.join(self.build_dir, 'xGIS{0}{1}'.format(os.sep, self.options['name']))
         logging.info('  Target folder: {0}'.format(self.target_dir))
-        os.makedirs(self.target_dir)
+        self._created_dirs = set()
+        self._makedirs(self.target_dir)
 
         # prepare config file and check for build configs
         self.make_config()
 
         # find and copy files based on inclusion, exclusion and remapping rules
-        include = self.options['include_data']
-        exclude = self.options['exclude_data']
-        remap = self.options['remap_folders']
-        self.finder('', include, exclude, remap)
+        self.finder()
         logging.info('  All files are ready for build')
 
     def build(self):
-        logging.info('  Compressing the folder {0}'.format(self.target_dir))
         os.chdir(self.build_dir)
-        if os.path.isfile('Installer.7z'):
-            os.remove('Installer.7z')
-        os.system('7z.exe a -t7z {0} {1}'.format('Installer.7z', 'xGIS'))
-
-        logging.info(' Building the installer')
-        copyfile(os.path.join(self.runtime_dir, '7zsd_All_x64.sfx'), os.path.join(self.build_dir, '7zsd_All_x64.sfx'))
         installer_filename = '{0}_v{1}.exe'.format(self.options['name'], self.options['version'])
         # installer_path = os.path.join(self.build_dir, installer_filename)
-        if os.path.isfile(installer_filename):
+        # start from a clean installer (a single unlink, no stat beforehand)
+        try:
             os.remove(installer_filename)
-        os.system('COPY /b 7zsd_All_x64.sfx + config.txt + Installer.7z {0}'.format(installer_filename))
-
-        if os.path.isfile(os.path.join(self.runtime_dir, 'xgis_ssl.pfx')):
+        except FileNotFoundError:
+            pass
+
+        # the installer is the sfx module, followed by the config and the archive
+        # 7zip prepends whatever module we give it, so the module+config prefix is written first (small)
+        # and the archive is then written once, straight into the installer
+        sfx_module = os.path.join(self.build_dir, 'Installer.sfx')
+        with open(sfx_module, 'wb') as module:
+            for part in [os.path.join(self.runtime_dir, '7zsd_All_x64.sfx'), 'config.txt']:
+                with open(part, 'rb') as f:
+                    copyfileobj(f, module)
+
+        logging.info('  Compressing the folder {0} into the installer {1}'.format(self.target_dir, installer_filename))
+        subprocess.run([self._tool('7z.exe'), 'a', '-t7z', '-sfx{0}'.format(sfx_module), installer_filename, 'xGIS'], check=True)
+
+        pfx_file = os.path.join(self.runtime_dir, 'xgis_ssl.pfx')
+        if self.options.get('sign', True) is not False and os.path.isfile(pfx_file):
             logging.info(' Signing the installer')
-            self.sign_installer(os.path.join(self.build_dir, installer_filename))
+            self.sign_installer(os.path.join(self.build_dir, installer_filename), pfx_file)
         return installer_filename
 
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _tool(name):
+        # the PATH is scanned only once per tool and per process
+        path = which(name)
+        if path is None:
+            raise RuntimeError('Could not find the {0} executable. Please install it before trying again, or add it to your PATH if already installed'.format(name))
+        return path
+
     def read_options(self):
         # load the config file
         if os.path.isfile('build_config.yaml'):
             logging.info('  Reading options from {0}'.format(os.path.abspath('build_config.yaml')))
-            self.options = yaml.load(open('build_config.yaml'), Loader=yaml.FullLoader)
+            with open('build_config.yaml', 'rb') as config:
+                self.options = yaml.load(config, Loader=_Loader)
         else:
             raise IOError('The build_config.yaml file is missing')
 
@@ -95,11 +162,22 @@ class Builder():
             if k not in self.supported_tags:
                 raise RuntimeError("The tag '{0}' is not supported".format(k))
 
+        # flatten the inclusion, exclusion and remapping rules once, by folder path (relative to root)
+        self._rules = {}
+        self._flatten_rules('', self.options['include_data'], self.options['exclude_data'], self.options['remap_folders'], self._rules)
+
+
+    @classmethod
+    def _get_template(cls, runtime_dir):
+        # the template does not change between builds, so it is read once per process
+        if cls._config_template is None:
+            with open(os.path.join(runtime_dir, 'config_template.txt')) as template:
+                cls._config_template = template.read()
+        return cls._config_template
 
     def make_config(self):
         # open template (this can be changed if you need)
-        with open(os.path.join(self.runtime_dir, 'config_template.txt')) as template:
-            config_text = template.read()
+        config_text = self._get_template(self.runtime_dir)
 
         # check for ArcGIS support
         if self.options['ArcGIS_support']:
@@ -122,7 +200,9 @@ class Builder():
             python_embedded_path = os.path.join(self.root_dir, self.options['Python_embedded'])
             if os.path.isfile(python_embedded_path):
                 # extract the python to the temporary folder to repack it later
-                unpack_archive(python_embedded_path, os.path.join(self.target_dir, 'python_embedded'))
+                # 7zip is much faster than unpack_archive on the thousands of small files, and also reads .7z archives
+                subprocess.run([self._tool('7z.exe'), 'x', '-y', '-o{0}'.format(os.path.join(self.target_dir, 'python_embedded')), python_embedded_path],
+                               check=True, stdout=subprocess.DEVNULL)
                 embedded = 1
             else:
                 raise FileNotFoundError("Could not find the python version to embed at: {0}".format(python_embedded_path))
@@ -169,77 +249,144 @@ class Builder():
             )
 
 
-    def finder(self, init_subpath, include, exclude, remap):
-        for k in include.keys():
-            # get current level of info
-            sub_include = include[k]
-            try:
-                sub_exclude = exclude[k]
-            except (KeyError, TypeError):
-                sub_exclude = False
-            try:
-                sub_remap = remap[k]
-            except (KeyError, TypeError):
-                sub_remap = False
-
-            # find the source path
-            current_subpath = os.path.join(init_subpath, k)
-
-            source_path = os.path.join(self.root_dir, current_subpath)
-            if not os.path.isdir(source_path):
-                raise IOError("Could not find the path '{0}'".format(source_path))
+    def finder(self):
+        rules = self._rules
+        # folders we need to descend into: the included ones and their parents
+        descend = set()
+        for subpath in rules:
+            # dirname stops changing at the drive or file system root of absolute paths
+            while subpath not in ('', '.') and subpath not in descend and subpath != os.path.dirname(subpath):
+                descend.add(subpath)
+                subpath = os.path.dirname(subpath)
+
+        # folders outside root_dir (e.g. '../shared' or absolute paths) are walked from their own location
+        walks = [('', self.root_dir)]
+        for subpath in rules:
+            if os.path.isabs(subpath) or subpath == os.pardir or subpath.startswith(os.pardir + os.sep):
+                parent = os.path.dirname(subpath)
+                while parent not in rules and parent != os.path.dirname(parent) and parent not in ('', '.'):
+                    parent = os.path.dirname(parent)
+                # only the outermost included folder, the walk covers its sub folders
+                if parent not in rules:
+                    walks.append((subpath, os.path.join(self.root_dir, rules[subpath][3])))
+
+        # locals are cheaper than attribute lookups in the walking loop
+        root_dir = self.root_dir
+        target_dir = self.target_dir
+        join = os.path.join
+        normpath = os.path.normpath
+        normcase = os.path.normcase
+        makedirs = self._makedirs
+        copier = self.copier
+
+        # the walk is pruned to the included folders, so following linked folders cannot loop or leave them
+        # the rules are keyed by normcase paths, to match the folders like the file system does (case insensitive on Windows)
+        def walk():
+            for walk_key, walk_root in walks:
+                for source_path, dirnames, filenames in os.walk(walk_root, topdown=True, followlinks=True):
+                    yield normcase(normpath(join(walk_key, os.path.relpath(source_path, walk_root)))), source_path, dirnames, filenames
+
+        found = set()
+        skipped = set()
+        for current_key, source_path, dirnames, filenames in walk():
+            # prune in place, so folders that are not included are never walked
+            dirnames[:] = [d for d in dirnames if normcase(normpath(join(current_key, d))) in descend]
+            if current_key not in rules:
+                continue
+            found.add(current_key)
+            sub_include, sub_exclude, sub_remap, current_subpath = rules[current_key]
+
+            # sub folders matching the exclusion list are skipped with all their content
+            if isinstance(sub_exclude, list) and dirnames:
+                exclude_re = _compile_patterns(sub_exclude)
+                for d in dirnames:
+                    if exclude_re.match(d):
+                        logging.info('  Skipping excluded folder: {0}'.format(join(source_path, d)))
+                        skipped.add(normcase(normpath(join(current_key, d))))
+                dirnames[:] = [d for d in dirnames if not exclude_re.match(d)]
 
             if isinstance(sub_remap, basestring):
-                dest_path = os.path.join(self.target_dir, sub_remap)
+                dest_path = join(target_dir, sub_remap)
             else:
-                dest_path = os.path.join(self.target_dir, current_subpath)
-            if not os.path.isdir(dest_path):
-                os.makedirs(dest_path)
-
-            # logging.info('looking into {0}'.format(source_path))
-            # logging.info('The content should be copied to {0}'.format(dest_path))
+                dest_path = join(target_dir, current_subpath)
+            makedirs(dest_path)
 
-            # if the content is still a dictionary, go deeper
+            # if the content is still a dictionary, the sub folders will be handled while walking
             if isinstance(sub_include, dict):
-                self.finder(current_subpath, sub_include, sub_exclude, sub_remap)
-            else:
-                logging.info('  Working on: {0}\n          Exclude: {1}\n          Remap: {2}\n          Destination: {3}'.format(
-                source_path, 
-                sub_exclude if sub_exclude else '', 
-                sub_remap if sub_remap else '',
-                dest_path))
-                # if the content is a list, we already have the list of files to copy
-                if isinstance(sub_include, list):
-                    files = []
-                    for p in sub_include:
-                        files.extend(list(self.list_files(source_path, p)))
-                    self.copier(files, source_path, dest_path)
-                elif sub_include is None:
-                    files = self.list_files(source_path)
-                    if isinstance(sub_exclude, list):
-                        exclude_files = []
-                        for p in sub_exclude:
-                            exclude_files.extend(list(self.list_files(source_path, p)))
-                        files = [f for f in files if f not in exclude_files]
-                    elif sub_exclude is False:
-                        pass
-                    else:
-                        raise TypeError('{0} is not a valid file exclusion list'.format(sub_exclude))
-                    self.copier(files, source_path, dest_path)
+                continue
+
+            logging.info('  Working on: {0}\n          Exclude: {1}\n          Remap: {2}\n          Destination: {3}'.format(
+            source_path,
+            sub_exclude if sub_exclude else '',
+            sub_remap if sub_remap else '',
+            dest_path))
+            # if the content is a list, we already have the list of files to copy
+            if isinstance(sub_include, list):
+                include_re = _compile_patterns(sub_include)
+                exclude_re = None
+            elif sub_include is None:
+                include_re = _ALL_FILES
+                if isinstance(sub_exclude, list):
+                    exclude_re = _compile_patterns(sub_exclude)
+                elif sub_exclude is False:
+                    exclude_re = None
                 else:
-                    raise TypeError("Could not process the folder '{0}'. Please specify files to include as lists (using -)".format(k) )
+                    raise TypeError('{0} is not a valid file exclusion list'.format(sub_exclude))
+            else:
+                raise TypeError("Could not process the folder '{0}'. Please specify files to include as lists (using -)".format(os.path.basename(current_subpath)))
+            files = [f for f in filenames if include_re.match(f) and not (exclude_re and exclude_re.match(f))]
+            copier(files, source_path, dest_path)
+
+        # every included folder must have been found while walking, unless it was excluded
+        for subpath in rules:
+            if subpath in found:
+                continue
+            parent = subpath
+            while parent not in ('', '.') and parent not in skipped and parent != os.path.dirname(parent):
+                parent = os.path.dirname(parent)
+            if parent not in skipped:
+                raise IOError("Could not find the path '{0}'".format(join(root_dir, rules[subpath][3])))
+
+    @classmethod
+    def _flatten_rules(cls, init_subpath, include, exclude, remap, rules):
+        for k in include.keys():
+            # get current level of info
+            sub_include = include[k]
+            # rules that are not nested any further do not apply to sub folders
+            sub_exclude = exclude.get(k, False) if isinstance(exclude, dict) else False
+            sub_remap = remap.get(k, False) if isinstance(remap, dict) else False
 
-    def sign_installer(self, installer_path):
+            current_subpath = os.path.join(init_subpath, k)
+            # keyed by the normcase path for the lookups while walking, the path as written is kept for the output folders
+            rules[os.path.normcase(os.path.normpath(current_subpath))] = (sub_include, sub_exclude, sub_remap, os.path.normpath(current_subpath))
+            # if the content is still a dictionary, go deeper
+            if isinstance(sub_include, dict):
+                cls._flatten_rules(current_subpath, sub_include, sub_exclude, sub_remap, rules)
+
+    def _makedirs(self, path):
+        # remember the folders (and their parents) already created, so sibling folders skip the syscalls
+        path = os.path.normpath(path)
+        if path in self._created_dirs:
+            return
+        os.makedirs(path, exist_ok=True)
+        while path not in self._created_dirs and path != os.path.dirname(path):
+            self._created_dirs.add(path)
+            path = os.path.dirname(path)
+
+    def sign_installer(self, installer_path, pfx_file):
         import getpass
-        config_file = os.path.join(self.runtime_dir, 'create_certificate.yaml')
-        paths = yaml.load(open(config_file), Loader=yaml.FullLoader)
+        # the certificate config is only read once, and only if we are signing
+        if self._cert_paths is None:
+            config_file = os.path.join(self.runtime_dir, 'create_certificate.yaml')
+            with open(config_file, 'rb') as config:
+                self._cert_paths = yaml.load(config, Loader=_Loader)
 
         password = getpass.getpass('  INPUT Password for the PFX file:')
 
         arguments = [
-            paths['signtool_path'],
+            self._cert_paths['signtool_path'],
             'sign',
-            '/f', '{0}'.format(os.path.join(self.runtime_dir, 'xgis_ssl.pfx')),
+            '/f', '{0}'.format(pfx_file),
             '/p', '{0}'.format(password),
             '/t', 'http://timestamp.digicert.com',
             installer_path
@@ -252,21 +399,22 @@ class Builder():
 
     @staticmethod
     def copier(files, source_dir, target_dir):
-        for f in files:
-            source = os.path.join(source_dir, f)
-            destination = os.path.join(target_dir, f)
-            if os.path.isfile(source):
-                logging.info('copying {0:100s} to {1:100s}'.format(source, destination))
-                copyfile(source, destination)
-            else:
-                raise IOError("Could not find file'{0}' in folder '{1}'".folder(f, source_dir))
-
-
-    @staticmethod
-    def list_files(path, pattern='*'):
-        for f in glob.glob(os.path.join(path, pattern)):
-            if os.path.isfile(os.path.join(path, f)):
-                yield os.path.basename(f)
+        # files come from os.walk, which already classified them while scanning the folder
+        # the message is only built if INFO is going to be logged
+        log_info = logging.getLogger().isEnabledFor(logging.INFO)
+        join = os.path.join
+        copy_file = _copy_file
+
+        def copy(f):
+            source = join(source_dir, f)
+            destination = join(target_dir, f)
+            if log_info:
+                logging.info('copying %s to %s', source, destination)
+            copy_file(source, destination)
+
+        # the copy happens outside the GIL, so keep several of them in flight
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 4) * 4)) as executor:
+            list(executor.map(copy, files))
 
 
 if __name__ == "__main__":
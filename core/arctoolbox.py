@@ -4,12 +4,57 @@ import re
 import winreg
 import logging
 import json
+import csv
+import itertools
+import time
+import atexit
+import threading
+from functools import lru_cache
 
 try:
     import arcpy
 except Exception:
     raise ImportError('Could not find the arcpy module. Are you running this toolbox from ArcGIS?')
 
+# patterns used by the toolbox utilities, compiled once
+_VERSION_RE = re.compile(r'Latest Version: ([0-9.]*)')
+# characters replaced by '_' in the output names
+_BAD_CHARS_TABLE = str.maketrans('-!@#$%^&()', '_' * 10)
+# fields and empty headers never listed by list_feature_fields
+_DEFAULT_EXCLUDED_FIELDS = frozenset(['Shape', 'FID', 'ID', '', None])
+
+
+# True if the name ends with a 2 to 4 lowercase letters extension, e.g. image.tif
+def _has_file_extension(name):
+    _, dot, ext = name.rpartition('.')
+    # explicit range check, as str.isascii is not available before python 3.7
+    return bool(dot) and 2 <= len(ext) <= 4 and all('a' <= c <= 'z' for c in ext)
+
+
+# "1.2.3" -> (1, 2, 3), the versions are the same on every check so the result is cached
+# empty parts (e.g. "1.2." or "1..3") are skipped, other invalid parts raise ValueError
+@lru_cache(maxsize=8)
+def _version_tuple(version):
+    return tuple(int(n) for n in version.split('.') if n)
+
+
+# read only the header of a csv file
+def _read_csv_header(path, encoding):
+    with open(path, 'r', newline='', encoding=encoding) as f:
+        line = f.readline()
+        # without quotes the header is a plain comma separated line
+        if '"' not in line:
+            return line.rstrip('\r\n').split(',') if line.strip('\r\n') else []
+        # quoted fields can contain commas and line breaks, so let csv.reader continue from the first line
+        return next(csv.reader(itertools.chain([line], f)))
+
+
+# get_outname only needs the paths from the Describe object, so it can be reused for the same source path
+@lru_cache(maxsize=128)
+def _describe_path(path):
+    return arcpy.Describe(path)
+
+
 class ArcToolbox(object):
     logger = None
     label = 'xGIS ArcToolbox'
@@ -17,6 +62,13 @@ class ArcToolbox(object):
     tools = []
     toolbox_version_file__ = ''
     version__ = ''
+    # the latest version is checked on every execution, so it is only fetched once every version_check_ttl seconds
+    version_check_ttl = 3600
+    _version_check = (None, 0, False)  # (version file, time of the check, latest version)
+    _http_session = None
+    # the xGIS registry key is opened once and shared by the user env utilities
+    _user_env_key = None
+    _user_env_lock = threading.Lock()
     # ToolParameterState = {}
 
     # stored_parameters_file = os.path.join(os.path.expanduser("~"), 'xGISparameters.txt')
@@ -41,47 +93,52 @@ class ArcToolbox(object):
     def store_parameters(cls, tool, parameter_list):
         intro = "** Storing " + tool + " parameters **"
         cls.logger.info(intro)
-        stored_parameters = []
-        for index, parameter in enumerate(parameter_list):
+        # reading the parameter values for the log is expensive, so only do it when they will be shown
+        log_info = cls.logger.isEnabledFor(logging.INFO)
+        # values and enabled states are kept in two parallel lists, in the parameters order
+        values = []
+        enabled = []
+        for parameter in parameter_list:
             # discard output parameters to avoid layer locking
             if parameter.direction == "Output":
-                stored_parameters.append([None, True])
-                cls.logger.info("Skipping {0}".format(parameter.name))
+                values.append(None)
+                enabled.append(True)
+                cls.logger.info("Skipping %s", parameter.name)
             else:
+                # valueAsText is read at most once, and only if it is logged or needed as the stored value
+                text = parameter.valueAsText if log_info else None
                 try:
-                    stored_parameters.append([parameter.values, parameter.enabled])
+                    values.append(parameter.values)
                 except AttributeError:
-                    stored_parameters.append([parameter.valueAsText, parameter.enabled])
-                try:
-                    cls.logger.info("  {0}: {1} {2}".format(parameter.name, parameter.valueAsText, type(parameter.value)))
-                except UnicodeEncodeError:
-                    cls.logger.info("  {0}: {1} {2}".format(parameter.name, parameter.valueAsText.encode('utf-8'), type(parameter.value)))
-        cls.ToolParameterState[tool] = stored_parameters
+                    values.append(parameter.valueAsText if text is None else text)
+                enabled.append(parameter.enabled)
+                if log_info:
+                    cls.logger.info("  %s: %s %s", parameter.name, text, type(parameter.value))
+        cls.ToolParameterState[tool] = {'values': values, 'enabled': enabled}
         cls.logger.info("*" * len(intro))
     # this method is used to get the parameters from the dictionary and use them as default for the GUI
     @classmethod
     def retrieve_parameters(cls, tool, parameter_list):
-        if tool not in cls.ToolParameterState.keys():
+        if tool not in cls.ToolParameterState:
             return
         intro = "** Retrieving " + tool + " parameters **"
         cls.logger.info(intro)
-        stored_parameters = cls.ToolParameterState[tool]
-        for index, parameter in enumerate(parameter_list):
-            if stored_parameters[index] is not None:
-                parameter.value = stored_parameters[index][0]
-                parameter.enabled = stored_parameters[index][1]
-                try:
-                    cls.logger.info("  {0}: {1}".format(parameter.name, parameter.valueAsText))
-                except UnicodeEncodeError:
-                    cls.logger.info("  {0}: {1}".format(parameter.name, parameter.valueAsText.encode('utf-8')))
+        log_info = cls.logger.isEnabledFor(logging.INFO)
+        state = cls.ToolParameterState[tool]
+        for parameter, value, enabled in zip(parameter_list, state['values'], state['enabled']):
+            parameter.value = value
+            parameter.enabled = enabled
+            if log_info:
+                cls.logger.info("  %s: %s", parameter.name, parameter.valueAsText)
         cls.logger.info("*" * len(intro))
     # this does retrieving and storing of output paths as environmental variables.
     # this is required because the GUI and background geoprocessing are not shared memory
 
     @classmethod
-    def manage_output(cls, key, value=False):
+    def manage_output(cls, key, value=False, stored=None):
         if value is False:
-            value = cls.get_user_env(key)
+            # stored can be the dictionary returned by get_user_envs, to avoid a registry query per key
+            value = cls.get_user_env(key) if stored is None else stored.get(key)
             if value is not None and os.path.isfile(value):
                 return value
             else:
@@ -93,32 +150,30 @@ class ArcToolbox(object):
     @classmethod
     def manage_parameters(cls, input_store_key=None):
         # this is a factory
+        # the keys do not change between calls, so resolve them once as (parameter index, stored key) pairs
+        if input_store_key is None:
+            in_keys = None
+        elif isinstance(input_store_key, str):
+            in_keys = ((0, input_store_key),)
+        elif isinstance(input_store_key, list):
+            in_keys = tuple((n, k) for n, k in enumerate(input_store_key) if k is not None)
+        elif isinstance(input_store_key, dict) and all(isinstance(k, int) for k in input_store_key.keys()) and all(isinstance(v, str) for v in input_store_key.values()):
+            in_keys = tuple(input_store_key.items())
+        else:
+            raise TypeError("Could not manage parameters. input_store_key is expected to be a str, list of str or dict of int:str")
+
         def manage_parameters_decorator(update_parms_func):
             if update_parms_func.__name__ != 'updateParameters':
                 raise ValueError("this decorator can be used only for the 'updateParameters' method")
             def do_manage(tool, parameters):
-                if all([ not p.hasBeenValidated for p in parameters]):
+                # only a fresh tool dialog needs the previous outputs, so stop at the first validated parameter
+                if not any(p.hasBeenValidated for p in parameters):
                     cls.logger.info("retrieve previous output")
-                    if input_store_key is not None:
-                        input_parms = []
-                        if isinstance(input_store_key, (str, unicode)):
-                            in_keys = [input_store_key]
-                        else:
-                            in_keys = input_store_key
-                        if isinstance(in_keys, list):
-                            for n, k in enumerate(in_keys):
-                                if k is None:
-                                    continue
-                                p = cls.manage_output(k)
-                                input_parms.append(p)
-                                parameters[n].value = p
-                        elif isinstance(in_keys, dict) and all([isinstance(k, int) for k in in_keys.keys()]) and all([isinstance(v, str) for v in in_keys.values()]):
-                            for k, v in in_keys.items():
-                                p = cls.manage_output(v)
-                                input_parms.append(p)
-                                parameters[k].value = p
-                        else:
-                            raise TypeError("Could not manage parameters. input_store_key is expected to be a str, list of str or dict of int:str")
+                    if in_keys is not None:
+                        # read all the stored outputs at once
+                        stored = cls.get_user_envs()
+                        for n, k in in_keys:
+                            parameters[n].value = cls.manage_output(k, stored=stored)
                     # if input_store_key is None or all([p is None for p in input_parms]):
                     #     cls.retrieve_parameters(tool.__class__.__name__, parameters)
                     else:
@@ -138,13 +193,15 @@ class ArcToolbox(object):
             if func.__name__ != 'execute':
                 raise ValueError("this decorator can be used only for the 'execute' method")
             def do_manage(tool, parameters, messages):
-                cls.logger.info('Running ' + cls.pckg_name__ + ' version ' + cls.version__ + ' released on ' + str(cls.release_date__))
+                cls.logger.info('Running %s version %s released on %s', cls.pckg_name__, cls.version__, cls.release_date__)
                 vc = cls.check_version()
                 if vc:
                     cls.logger.warning('You are running an old toolbox version. A newer one ({0}) is available for download at {1}'.format('.'.join(vc), cls.toolbox_repository__))
-                cls.logger.info('__Starting ' + tool.__class__.__name__ + '__')
+                cls.logger.info('__Starting %s__', tool.__class__.__name__)
 
                 output = func(tool, parameters, messages)
+                # the execution may have created or replaced datasets, so do not reuse older descriptions
+                _describe_path.cache_clear()
                 if output and parameters[-1].parameterType == 'Derived' and not parameters[-1].value:
                     arcpy.SetParameter(len(parameters) - 1, output)
 
@@ -159,19 +216,24 @@ class ArcToolbox(object):
                         if len(out_keys) != len(output):
                             raise RuntimeError("Could not manage output. Expected {0} output but received {1}".format(len(out_keys), len(output)))
                         else:
-                            for o, k in zip(output, out_keys):
-                                cls.manage_output(k, o)
+                            cls.set_user_envs(zip(out_keys, output))
                 return
             return do_manage
         return manage_execution_decorator
 
     @classmethod
     def manage_required_parameters(cls, control_parameter_idx=None, required_indices=[]):
+        # the arguments are fixed, so check them once when the decorator is built
+        if not isinstance(control_parameter_idx, int) or control_parameter_idx < 0:
+            raise TypeError("Control_parameter must be a valid parameter index ")
+        if not isinstance(required_indices, (list, tuple)) or not all(isinstance(l, (list, tuple)) for l in required_indices):
+            raise TypeError("required_indices must be a list of lists")
+
         def manage_required_parameters_decorator(func):
             if func.__name__ != 'updateMessages':
                 raise ValueError("this decorator can be used only for the 'updateMessages' method")
             def do_manage(tool, parameters):
-                if not isinstance(control_parameter_idx, int) or control_parameter_idx>len(parameters) or control_parameter_idx < 0:
+                if control_parameter_idx >= len(parameters):
                     raise TypeError("Control_parameter must be a valid parameter index ")
                 control_parameter = parameters[control_parameter_idx]
                 try:
@@ -184,14 +246,13 @@ class ArcToolbox(object):
                     else:
                         raise ValueError("Control_parameter must have a value filter set or being Boolean, not {0}".format(control_parameter.datatype))
 
-                if not isinstance(required_indices, (list, tuple)) or any([not isinstance(l, (list, tuple)) for l in required_indices]):
-                    raise TypeError("required_indices must be a list of lists")
-                
                 if len(control_options) != len(required_indices):
                     raise ValueError("number of options in the control_parameter and number of list of required parameters must be the same")
 
+                # read the control value once, not once per option
+                control_value = control_parameter.value
                 for control, required in zip(control_options, required_indices):
-                    if control_parameter.value == control:
+                    if control_value == control:
                         for r in required:
                             if not parameters[r].altered or not parameters[r].value:
                                 parameters[r].setIDMessage("ERROR", 735, parameters[r].displayName)
@@ -202,21 +263,37 @@ class ArcToolbox(object):
 
 
     @classmethod
-    def check_version(cls):
+    def get_latest_version(cls):
+        version_file, checked_on, version = cls._version_check
+        # monotonic, so changes to the system clock do not affect the cache
+        if version_file == cls.toolbox_version_file__ and time.monotonic() - checked_on < cls.version_check_ttl:
+            return version
         import requests
         try:
-            text = requests.get(cls.toolbox_version_file__).text
-            version = re.match('Latest Version: ([0-9.]*)', text).group(1)
+            # reuse the connection between checks
+            if ArcToolbox._http_session is None:
+                ArcToolbox._http_session = requests.Session()
+            # do not let a slow connection hold the tool for long
+            text = ArcToolbox._http_session.get(cls.toolbox_version_file__, timeout=2).text
+            version = _VERSION_RE.match(text).group(1)
+            # parse it here, so an unusable version is cached as no version at all
+            parsed = _version_tuple(version)
+            version = '.'.join(str(n) for n in parsed) if parsed else False
         except Exception:
             version = False
+        cls._version_check = (cls.toolbox_version_file__, time.monotonic(), version)
+        return version
+
+    @classmethod
+    def check_version(cls):
+        version = cls.get_latest_version()
         if version:
-            version = version.split('.')
-            tool_version = cls.version__.split('.')
-            for o, n in zip(tool_version, version):
-                if int(o) < int(n):
-                    break
-            else:
-                version = False
+            try:
+                newer = _version_tuple(version) > _version_tuple(cls.version__)
+            except ValueError:
+                # a version we cannot compare is not reported as an update
+                newer = False
+            version = version.split('.') if newer else False
         return version
 
     @staticmethod
@@ -233,13 +310,31 @@ class ArcToolbox(object):
         out : str
             variable value
         """
-        key = winreg.CreateKeyEx(winreg.HKEY_CURRENT_USER, r"xGIS", 0, winreg.KEY_READ)
         try:
-            return winreg.QueryValueEx(key, name)[0]
+            return ArcToolbox._with_user_env_key(lambda key: winreg.QueryValueEx(key, name)[0])
         except WindowsError:
             return None
-        finally:
-            winreg.CloseKey(key)
+
+    @staticmethod
+    def get_user_envs():
+        """Utility to retrieve all the xGIS Windows environmental variables at once
+
+        Returns:
+        -----------
+        out : dict
+            variable names and values
+        """
+        def read_all(key):
+            values = {}
+            for i in range(winreg.QueryInfoKey(key)[1]):
+                name, value, _ = winreg.EnumValue(key, i)
+                values[name] = value
+            return values
+
+        try:
+            return ArcToolbox._with_user_env_key(read_all)
+        except WindowsError:
+            return {}
 
     @staticmethod
     def set_user_env(name, value):
@@ -252,29 +347,75 @@ class ArcToolbox(object):
         value : str
             variable value
         """
-        key = winreg.CreateKeyEx(winreg.HKEY_CURRENT_USER, r"xGIS", 0, winreg.KEY_SET_VALUE)
-        try:
-            winreg.SetValueEx(key, name, 0, winreg.REG_SZ, value)
-        finally:
-            winreg.CloseKey(key)
+        ArcToolbox._with_user_env_key(lambda key: winreg.SetValueEx(key, name, 0, winreg.REG_SZ, value))
+
+    @staticmethod
+    def set_user_envs(items):
+        """Utility to assign several Windows environmental variables at once
+
+        Arguments:
+        -----------
+        items : iterable of (str, str)
+            variable names and values
+        """
+        # the items may be an iterator, and the writes may be retried
+        items = list(items)
+
+        def write_all(key):
+            for name, value in items:
+                winreg.SetValueEx(key, name, 0, winreg.REG_SZ, value)
+
+        ArcToolbox._with_user_env_key(write_all)
 
     @staticmethod
     def del_user_env(name=None):
         try:
             if name is None:
+                # the shared handle would point to a deleted key, so close it first
+                ArcToolbox._close_user_env_key()
                 winreg.DeleteKeyEx(winreg.HKEY_CURRENT_USER, r"xGIS", winreg.KEY_ALL_ACCESS, 0)
             else:
-                key = winreg.OpenKeyEx(winreg.HKEY_CURRENT_USER, r"xGIS", 0, winreg.KEY_SET_VALUE)
-                winreg.DeleteValue(key, name)
+                ArcToolbox._with_user_env_key(lambda key: winreg.DeleteValue(key, name))
         except WindowsError:
             pass
 
+    # open the xGIS registry key on first use, and keep it for the following calls
+    @staticmethod
+    def _get_user_env_key():
+        with ArcToolbox._user_env_lock:
+            if ArcToolbox._user_env_key is None:
+                ArcToolbox._user_env_key = winreg.CreateKeyEx(winreg.HKEY_CURRENT_USER, r"xGIS", 0, winreg.KEY_READ | winreg.KEY_SET_VALUE)
+                # release the handle when the session ends
+                atexit.unregister(ArcToolbox._close_user_env_key)
+                atexit.register(ArcToolbox._close_user_env_key)
+            return ArcToolbox._user_env_key
+
+    # if key is given, it is only closed if it is still the shared one (another thread may have reopened it already)
+    @staticmethod
+    def _close_user_env_key(key=None):
+        with ArcToolbox._user_env_lock:
+            if ArcToolbox._user_env_key is not None and (key is None or key is ArcToolbox._user_env_key):
+                winreg.CloseKey(ArcToolbox._user_env_key)
+                ArcToolbox._user_env_key = None
+
+    # call func with the shared key, reopening it once if it is not valid anymore
+    # e.g. the xGIS key was deleted by del_user_env or by another process since it was opened
+    @staticmethod
+    def _with_user_env_key(func):
+        key = ArcToolbox._get_user_env_key()
+        try:
+            return func(key)
+        except FileNotFoundError:
+            # a missing value, the key itself is still valid
+            raise
+        except WindowsError:
+            ArcToolbox._close_user_env_key(key)
+            return func(ArcToolbox._get_user_env_key())
+
     @staticmethod
     def parameter_has_been_modified(param):
-        if param.value and not param.hasBeenValidated:
-            return True
-        else:
-            return False
+        # hasBeenValidated is only read when there is a value
+        return bool(param.value) and not param.hasBeenValidated
 
 
 
@@ -284,48 +425,62 @@ class ArcToolbox(object):
             raise TypeError("The parameter provided is not a multiValue")
         values = param.valueAsText.split(';')
         if param.datatype == 'String':
-            for n, v in enumerate(values):
-                if v.startswith("'"):
-                    v = v[1:]
-                if v.endswith("'"):
-                    v = v[:-1]
-                values[n] = v
+            # remove one quote at each end, if present (strip would also remove quotes that are part of the value)
+            values = [v[v.startswith("'"):len(v) - v.endswith("'")] for v in values]
         elif param.datatype == 'Double':
-            values = [float(v) for v in values]
+            values = list(map(float, values))
         elif param.datatype == 'Long':
-            values = [int(v) for v in values]
+            values = list(map(int, values))
         else:
             raise NotImplementedError("parameter datatype {0} is not supported".format(param.datatype))
         return values
 
     @staticmethod
-    def list_feature_fields(value, exclude=[]):
+    def list_feature_fields(value, exclude=()):
         path = str(value)
-        exclude += ['Shape', 'FID', 'ID']
+        # built once, and without changing the list passed by the caller
+        exclude = frozenset(exclude) | _DEFAULT_EXCLUDED_FIELDS
         if path.endswith('xls') or path.endswith('xlsx'):
-            import xlrd
-            sheet = xlrd.open_workbook(path).sheet_by_index(0)
-            if sheet.ncols == 0:
+            if path.endswith('xlsx'):
+                # the read-only mode streams the sheet, so only the first row is parsed
+                from openpyxl import load_workbook
+                workbook = load_workbook(path, read_only=True, data_only=True)
+                try:
+                    cols = list(next(workbook.worksheets[0].iter_rows(max_row=1, values_only=True), ()))
+                finally:
+                    workbook.close()
+            else:
+                # xlrd only supports the old xls format, and on_demand avoids loading the other sheets
+                import xlrd
+                sheet = xlrd.open_workbook(path, on_demand=True).sheet_by_index(0)
+                cols = [sheet.cell(0, i).value for i in range(sheet.ncols)]
+            if len(cols) == 0:
                 raise ValueError("the Excel file appears to be empty. Detected 0 columns")
-            cols = [sheet.cell(0, i).value for i in range(sheet.ncols)]
-            cols = [c for c in cols if c not in exclude + ['', None]]
+            cols = [c for c in cols if c not in exclude]
             cols = [c.encode('ascii', 'replace') for c in cols]
             if len(cols) == 0:
                 raise ValueError("Excel file incorrectly formatted. Please make sure that the first column contains column headers with no gaps")
             return cols
         elif path.endswith('csv'):
-            import csv
-            with open(path, 'r') as f:
-                reader = csv.reader(f)
-                cols = list(next(reader))
-            cols = [c for c in cols if c not in exclude + ['', None]]
+            # try utf-8 first (skipping the BOM written by Excel), then the platform encoding used by older exports
+            try:
+                cols = _read_csv_header(path, 'utf-8-sig')
+            except UnicodeDecodeError:
+                cols = _read_csv_header(path, None)
+            cols = [c for c in cols if c not in exclude]
             return cols
         else:
-            return [str(x.name) for x in arcpy.ListFields(value) if not x.name in exclude]
+            return [str(x.name) for x in arcpy.ListFields(value) if x.name not in exclude]
 
     @staticmethod
     def list_unique_field_values(table, field):
-        with arcpy.da.SearchCursor(table, [field]) as cursor:
+        # let the data source return the distinct values when it can (e.g. geodatabases)
+        # the set still removes the duplicates for the formats ignoring the DISTINCT prefix
+        try:
+            cursor = arcpy.da.SearchCursor(table, [field], sql_clause=('DISTINCT', None))
+        except RuntimeError:
+            cursor = arcpy.da.SearchCursor(table, [field])
+        with cursor:
             return sorted({row[0] for row in cursor})
 
     @staticmethod
@@ -363,13 +518,13 @@ class ArcToolbox(object):
         try:
             try:
                 # try to convert the input to Describe object
-                meta = arcpy.Describe(source)
+                meta = _describe_path(source) if isinstance(source, str) else arcpy.Describe(source)
             except:
                 # if cannot perform the Describe operation we assume it is already a Describe bj
                 meta = source
 
             # _ = meta.file  # BUG This should make sure that the attribute is updated before calling it. Sometimes this changes while running!
-            if re.match('^.*\.[a-z]{2,4}$', meta.file) is None:
+            if not _has_file_extension(meta.file):
                 # the path is for a image band (not a real path)
                 meta_path = os.path.dirname(meta.catalogPath)
             else:
@@ -379,7 +534,8 @@ class ArcToolbox(object):
             # to be able to use this outside the ArcGIS environment
             meta_path = source
 
-        basename = os.path.splitext(re.sub('[-!@#$%^&()]', '_', os.path.basename(meta_path)))[0]
+        # the table does not touch '.', so only the name without the extension needs to be translated
+        basename = os.path.splitext(os.path.basename(meta_path))[0].translate(_BAD_CHARS_TABLE)
         if extract_basename_root:
             basename = basename.split('_')[0]
 
@@ -417,12 +573,19 @@ class ArcToolbox(object):
         if overwrite:
             return os.path.normpath(''.join([dirpath, basename, suffix, optional_ext]))
         else:
+            # list the folder once instead of checking every candidate name
+            # geodatabase content cannot be listed like that, and the folder may not exist, so fall back to checking each path
+            existing = None
+            if '.gdb' not in dirpath:
+                try:
+                    existing = set(os.path.normcase(f) for f in os.listdir(dirpath or os.curdir))
+                except OSError:
+                    pass
+            # only the counter changes between the candidates, and the path is only needed for the fallback and the result
+            name = basename + suffix + optional_ext
+            head = basename + suffix
             count = 0
-
-            while True:
-                path = os.path.normpath(''.join([dirpath, basename, suffix] + ['' if count == 0 else str(count)] + [optional_ext]))
-                if os.path.exists(path):
-                    count += 1
-                else:
-                    break
-            return path
+            while (os.path.normcase(name) in existing) if existing is not None else os.path.exists(os.path.normpath(dirpath + name)):
+                count += 1
+                name = '{0}{1}{2}'.format(head, count, optional_ext)
+            return os.path.normpath(dirpath + name)
@@ -1,12 +1,14 @@
 import os
 import sys
 import re
+import stat
 import logging
 import subprocess
 from queue import Queue, Empty
+from collections import deque
 from threading import Thread, Event
-from distutils.spawn import find_executable
 from time import sleep
+from functools import lru_cache
 try:
     import arcpy # noqa
 except ImportError:
@@ -27,6 +29,9 @@ except NameError:
     # python 3
     basestring = (str, bytes)
 
+# pattern used to pick the results from the subprocess output, compiled once
+_RESULT_RE = re.compile('RESULT: ([^\r\n]*)')
+
 #this is to support embedded python, will be False if none is found
 embedded_python_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'python_embedded{0}python.exe'.format(os.sep))
 if os.path.isfile(embedded_python_path):
@@ -34,6 +39,57 @@ if os.path.isfile(embedded_python_path):
 else:
     embedded_python_path = False
 
+# system-wide search for an executable, as done by distutils.spawn.find_executable (distutils was removed in python 3.12)
+# on Windows '.exe' is added to the name, then the name is tested in the current directory and in every PATH folder
+def find_executable(executable, path=None):
+    if sys.platform == 'win32' and os.path.splitext(executable)[1] != '.exe':
+        executable = executable + '.exe'
+    if os.path.isfile(executable):
+        return executable
+    if path is None:
+        path = os.environ.get('PATH', None)
+        if path is None:
+            try:
+                path = os.confstr('CS_PATH')
+            except (AttributeError, ValueError):
+                path = os.defpath
+    if not path:
+        return None
+    for p in path.split(os.pathsep):
+        f = os.path.join(p, executable)
+        if os.path.isfile(f):
+            return f
+    return None
+
+
+# find_executable scans every folder in PATH, so remember where each name was found
+# the key includes PATH and the working directory, as both change the result
+_find_executable_cache = {}
+
+
+def _find_executable(name):
+    key = (name, os.environ.get('PATH', os.defpath), os.getcwd())
+    path = _find_executable_cache.get(key)
+    # check that the file is still there before reusing it
+    if path is None or not os.path.isfile(path):
+        path = find_executable(name)
+        if path is None:
+            _find_executable_cache.pop(key, None)
+        else:
+            _find_executable_cache[key] = path
+    return path
+
+
+# True if the path is a file that can be executed, using a single stat call
+def _is_executable(path):
+    try:
+        mode = os.stat(path).st_mode
+    except (OSError, ValueError):
+        return False
+    # on Windows every file passes the os.access X_OK test, so only check that it is a file
+    return stat.S_ISREG(mode) and (os.name == 'nt' or bool(mode & 0o111))
+
+
 class ExternalExecutionError(Exception):
     # custom error for abnormal process termination
     def __init__(self, message, errno=1):
@@ -139,6 +195,8 @@ class Executor(object):
     host = None
     post_task_function = False
     task_id = None
+    # number of stderr lines kept to be printed when the subprocess fails
+    max_error_lines = 1000
 
     # initialise
     def __init__(self, cmd_line, executable=False, external_libs=False, cwd=False, logger=False, post_task_function=False):
@@ -218,11 +276,14 @@ class Executor(object):
                 test = lambda x: os.path.isdir(x)  # noqa: E731
                 test_str = 'directory'
             else:
-                test = lambda x: os.path.isfile(x) and os.access(x, os.X_OK)  # noqa: E731
+                test = _is_executable
                 test_str = 'executable'
         # run the test function
         # testing both the 'local' path and the 'working directory' one
-        for d in [os.path.abspath(dir), os.path.join(self.cwd, dir)]:
+        # they are the same path for absolute paths (or when cwd is the current directory), so test it only once
+        local = os.path.abspath(dir)
+        in_cwd = os.path.join(self.cwd, dir)
+        for d in [local] if os.path.normcase(os.path.normpath(in_cwd)) == os.path.normcase(local) else [local, in_cwd]:
             if test(d):
                 return str(d)
         else:
@@ -298,20 +359,24 @@ class Executor(object):
         if not isinstance(cmd_line, list):
             raise TypeError("The 'cmd_line' argument must be a list of strings")
         # in fact must be a list of strings
-        if not all([isinstance(x, basestring) for x in cmd_line]):
+        if not all(isinstance(x, basestring) for x in cmd_line):
             list_error = ', '.join(['{0}[{1}]'.format(str(a), type(a)) for a in cmd_line])
             raise TypeError("The 'cmd_line' argument must be a list of strings. You passed: {}".format(list_error))
         cmd_line = cmd_line[:]  # to copy the list
         script = cmd_line.pop(0)  # remove the first argument (script/executable) for testing
         try:
-            # is this in any of the folders we know?
-            script_path = self._check_paths(script, is_file=True)
+            # an existing absolute path needs no search
+            if os.path.isabs(script) and os.path.isfile(script):
+                script_path = os.path.normpath(script)
+            else:
+                # is this in any of the folders we know?
+                script_path = self._check_paths(script, is_file=True)
             # it exists, and it is an executable itself, so we need to remove the attribute executable
             if script_path.endswith('.exe'):
                 self.set_executable(None)
         except IOError:
             # We could not find it in the folders we know, so let's do a system-wide search
-            script_path = find_executable(script)
+            script_path = _find_executable(script)
             if script_path is None:
                 raise TypeError('The first argument must be your script/executable. Could not resolve {0}'.format(script))
             # found it!
@@ -368,18 +433,24 @@ class Executor(object):
             self._set_lib_path(external_libs)
 
         # multiple paths passed
-        elif isinstance(external_libs, list) and all([isinstance(x, basestring) for x in external_libs]):
-            external_libs_copy = external_libs[:]  # to make a copy
-            external_libs = []
-            for e_l in external_libs_copy:
+        elif isinstance(external_libs, list):
+            # check the type and the folder of each item in one pass, before changing the environment
+            resolved = []
+            for e_l in external_libs:
+                if not isinstance(e_l, basestring):
+                    raise TypeError("The 'external_libs' argument must be a string or list of strings")
                 try:
-                    external_libs.append(self._check_paths(e_l, is_dir=True))
+                    resolved.append(self._check_paths(e_l, is_dir=True))
                 except IOError:
                     raise IOError("The 'external_libs' argument has at least one non-valid folder. Couldn't resolve {0}".format(e_l))
 
             self._environ = os.environ.copy()
-            for p in external_libs[::-1]:
-                self._set_lib_path(os.path.abspath(p))
+            # collect the paths of all the libraries, and update the environment once
+            # _check_paths already returns absolute paths
+            parts = {'PATH': [], 'PYTHONPATH': []}
+            for p in reversed(resolved):
+                self._set_lib_path(p, parts)
+            self._prepend_env(parts)
 
         # no path passed, default to current environment
         elif external_libs is False:
@@ -443,12 +514,13 @@ class Executor(object):
     def _info_printer(self, head, to_print):
         # head is the line header, like PATH or "working directory"
         # to_print is the list of info to print
+        # the arguments are passed to the logger, so nothing is formatted if INFO is disabled
         if isinstance(to_print, basestring):
-            self.logger.info('   %-20s: %-20s' % (head, to_print))
+            self.logger.info('   %-20s: %-20s', head, to_print)
         elif isinstance(to_print, list):
             # splitting them into multiple lines
             for s in to_print:
-                self.logger.info('   %-20s: %-20s' % (head, s))
+                self.logger.info('   %-20s: %-20s', head, s)
                 # removing the line header after the first line
                 head = ''
 
@@ -541,6 +613,13 @@ class Executor(object):
         producer_thread = Thread(target=self._print_stream, args=(popen.stdout, log_queue))
         producer_thread.setDaemon(True)
         producer_thread.start()
+        # stderr is only printed if the process fails, but it must be read while it runs
+        # otherwise a process writing a lot to stderr blocks once the pipe is full
+        error_lines = deque(maxlen=self.max_error_lines)
+        error_count = [0]  # number of lines read, including the ones dropped by the deque
+        error_thread = Thread(target=self._collect_stream, args=(popen.stderr, error_lines, error_count))
+        error_thread.setDaemon(True)
+        error_thread.start()
 
         # this thread will act on the cancellation event
         is_cancelling = False
@@ -587,7 +666,12 @@ class Executor(object):
         if popen.returncode > 0:
             logger.warning('   ***** SubProcess Failed *****')
             # if this is the case, print the error stream as well
-            for l, _ in Executor._print_stream(popen.stderr):
+            # the process has ended, so the reader stops as soon as it has read the rest of the stream
+            error_thread.join()
+            omitted = error_count[0] - len(error_lines)
+            if omitted > 0:
+                logger.warning('   ... {0} earlier stderr lines omitted'.format(omitted))
+            for l in error_lines:
                 if bool(l):
                     logger.warning('   {0}'.format(l))  # TODO ArcGIS exits after the first AddError is called. Need to find a solution to still print the entire traceback to stderr
 
@@ -622,7 +706,7 @@ class Executor(object):
             # if we have a queue, use that to pass the messages
             if log_queue is not False:
                 for line in iter(_line_converter, ""):
-                    result = re.findall('RESULT: ([^\r\n]*)', line)
+                    result = _RESULT_RE.findall(line)
                     if result:
                         log_queue.put(('', result))
                     else:
@@ -633,49 +717,68 @@ class Executor(object):
                 return [(line, '') for line in iter(_line_converter, "")]
 
 
+    # internal reader used in _stream_handler to keep the last lines of a stream
+    # count[0] is incremented for every line read, so the caller knows how many were dropped by a bounded lines deque
+    @staticmethod
+    def _collect_stream(stream, lines, count):
+        if stream:
+            for line in iter(stream.readline, b''):
+                if hasattr(line, 'decode'):
+                    line = line.decode('utf-8', 'replace')
+                lines.append(line)
+                count[0] += 1
+
     # internal method to discover and set subpath for the external libraries. This will modify the environment copy
-    def _set_lib_path(self, extlib_path):
+    # if parts is given, the new entries are prepended to its 'PATH' and 'PYTHONPATH' lists, and written to the environment by the caller
+    def _set_lib_path(self, extlib_path, parts=None):
+        write_env = parts is None
+        if write_env:
+            parts = {'PATH': [], 'PYTHONPATH': []}
         _path = []
         _pythonpath = []
+        # folder listings shared by the checks below, so each parent folder is read only once
+        listed = {}
+        check = lambda p, str=False: self._check_dir_path(p, str, listed)  # noqa: E731
 
-        if self._check_dir_path(extlib_path):
+        if os.path.isdir(extlib_path):
             # C://Tests/blabla/external_libs
-            _path.extend(self._check_dir_path(extlib_path))  # CONDA PIP
+            _path.append(extlib_path)  # CONDA PIP
             # C://Tests/blabla/external_libs/Python27/site-packages
-            for f in os.listdir(extlib_path):
+            extlib_path_distro = None
+            for f in self._list_dirs(extlib_path, listed).values():
                 if f.startswith('Python'):
-                    extlib_path_distro = os.path.join(extlib_path, f + os.sep + 'site-packages')
-                    _pythonpath.extend(self._check_dir_path(extlib_path_distro))
-                    _path.extend(self._check_dir_path(os.path.join(extlib_path, 'Scripts')))
+                    extlib_path_distro = os.path.join(extlib_path, f, 'site-packages')
+                    _pythonpath.extend(check(extlib_path_distro))
+                    _path.extend(check(os.path.join(extlib_path, 'Scripts')))
 
             # C://Tests/blabla/external_libs/DLLs
-            _pythonpath.extend(self._check_dir_path(os.path.join(extlib_path, 'DLLs')))  # CONDA
+            _pythonpath.extend(check(os.path.join(extlib_path, 'DLLs')))  # CONDA
             # C://Tests/blabla/external_libs/bin
-            _path.extend(self._check_dir_path(os.path.join(extlib_path, 'bin')))  # CONDA
+            _path.extend(check(os.path.join(extlib_path, 'bin')))  # CONDA
 
             # C://Tests/blabla/external_libs/lib
-            lib_path = self._check_dir_path(os.path.join(extlib_path, 'lib'), True)  # CONDA
+            lib_path = check(os.path.join(extlib_path, 'lib'), True)  # CONDA
             if lib_path:
                 _pythonpath.append(lib_path)
 
                 # C://Tests/blabla/external_libs/lib/site-packages
-                _pythonpath.extend(self._check_dir_path(os.path.join(lib_path, 'site-packages')))  # CONDA PIP
+                _pythonpath.extend(check(os.path.join(lib_path, 'site-packages')))  # CONDA PIP
                 # C://Tests/blabla/external_libs/lib/lib-tk
-                _pythonpath.extend(self._check_dir_path(os.path.join(lib_path, 'lib-tk')))  # CONDA
+                _pythonpath.extend(check(os.path.join(lib_path, 'lib-tk')))  # CONDA
                 # C://Tests/blabla/external_libs/lib/plat-win
-                _pythonpath.extend(self._check_dir_path(os.path.join(lib_path, 'plat-win')))  # CONDA
+                _pythonpath.extend(check(os.path.join(lib_path, 'plat-win')))  # CONDA
 
             # C://Tests/blabla/external_libs/Library
-            libos_path = self._check_dir_path(os.path.join(extlib_path, 'Library'), True)
+            libos_path = check(os.path.join(extlib_path, 'Library'), True)
             if libos_path:
                 _path.append(libos_path)
 
                 # C://Tests/blabla/external_libs/Library/bin
-                _path.extend(self._check_dir_path(libos_path, 'bin'))  # CONDA
+                _path.extend(check(os.path.join(libos_path, 'bin')))  # CONDA
                 # C://Tests/blabla/external_libs/Library/usr/bin
-                _path.extend(self._check_dir_path(libos_path, 'usr' + os.sep + 'bin'))  # CONDA
+                _path.extend(check(os.path.join(libos_path, 'usr', 'bin')))  # CONDA
                 # C://Tests/blabla/external_libs/Library/mingw-w64/bin
-                _path.extend(self._check_dir_path(libos_path, 'mingw-w64' + os.sep + 'bin'))  # CONDA
+                _path.extend(check(os.path.join(libos_path, 'mingw-w64', 'bin')))  # CONDA
 
             self.logger.debug('PATH: {0}'.format(str(_path)))
             self.logger.debug('PYTHONPATH: {0}'.format(str(_pythonpath)))
@@ -684,45 +787,54 @@ class Executor(object):
                 _path.extend(_pythonpath)
                 _pythonpath = _path
 
-            try:
-                self._environ['PATH'] = ';'.join(_path + [self._environ['PATH']])#.encode('utf8')
-            except KeyError:
-                self._environ['PATH'] = ';'.join(_path)#.encode('utf8')
-            try:
-                self._environ['PYTHONPATH'] = ';'.join(_pythonpath + [self._environ['PYTHONPATH']])#.encode('utf8')
-            except KeyError:
-                self._environ['PYTHONPATH'] = ';'.join(_pythonpath)#.encode('utf8')
+            parts['PATH'][:0] = _path
+            parts['PYTHONPATH'][:0] = _pythonpath
 
             # special case for GDAL
             # C://Tests/blabla/external_libs/osgeo or
             # C://Tests/blabla/external_libs/site-packages/osgeo
-            gdal_optional_paths = [
-                os.path.join(os.path.dirname(extlib_path), 'osgeo'),
-                os.path.join(os.path.join(lib_path, 'site-packages'), 'osgeo'),
-            ]
+            gdal_optional_paths = [os.path.join(os.path.dirname(extlib_path), 'osgeo')]
+            if lib_path:
+                gdal_optional_paths.append(os.path.join(lib_path, 'site-packages', 'osgeo'))
             # C://Tests/blabla/external_libs/Python27/site-packages/osgeo
             if extlib_path_distro:
                 gdal_optional_paths.append(os.path.join(extlib_path_distro, 'osgeo'))
             for gdal_path in gdal_optional_paths:
-                if os.path.isdir(gdal_path):
+                if check(gdal_path, True):
                     # C://Tests/blabla/external_libs/osgeo/gdalplugins or
                     # C://Tests/blabla/external_libs/site-packages/osgeo/gdalplugins
-                    gdal_plugins = self._check_dir_path(os.path.join(gdal_path, 'gdalplugins'), True)
+                    gdal_plugins = check(os.path.join(gdal_path, 'gdalplugins'), True)
                     # C://Tests/blabla/external_libs/osgeo/gdal-data or
                     # C://Tests/blabla/external_libs/site-packages/osgeo/gdal-data
-                    gdal_data = self._check_dir_path(os.path.join(gdal_path, 'gdal-data'), True)
-                    self._environ['PATH'] = ';'.join([gdal_path, gdal_data, gdal_plugins, str(self._environ['PATH'])])#.encode('utf8')
+                    gdal_data = check(os.path.join(gdal_path, 'gdal-data'), True)
+                    parts['PATH'][:0] = [gdal_path, gdal_data, gdal_plugins]
                     self._environ['GDAL_DRIVER_PATH'] = gdal_plugins#.encode('utf8')
                     self._environ['GDAL_DATA'] = gdal_data#.encode('utf8')
                     break
 
+            if write_env:
+                self._prepend_env(parts)
         else:
             raise IOError('The path {0} could not be found'.format(str(extlib_path)))
 
+    # internal method to prepend the paths collected by _set_lib_path to the environment copy, joining each variable once
+    def _prepend_env(self, parts):
+        for key, values in parts.items():
+            try:
+                self._environ[key] = ';'.join(values + [self._environ[key]])
+            except KeyError:
+                self._environ[key] = ';'.join(values)
+
     # internal method used by _set_lib_path to discover subfolders
+    # if listed is a dictionary, the folders are looked up in the listing of their parent instead of being tested one by one
     @staticmethod
-    def _check_dir_path(p, str=False):
-        if os.path.isdir(p):
+    def _check_dir_path(p, str=False, listed=None):
+        if listed is None:
+            found = os.path.isdir(p)
+        else:
+            parent, name = os.path.split(p)
+            found = os.path.normcase(name) in Executor._list_dirs(parent, listed)
+        if found:
             if str:
                 return p
             return [p]
@@ -731,8 +843,37 @@ class Executor(object):
                 return ''
             return []
 
+    # internal method returning the subfolders of parent as {normcase(name): name}, listing each parent only once
+    @staticmethod
+    def _list_dirs(parent, listed):
+        try:
+            return listed[parent]
+        except KeyError:
+            pass
+        dirs = {}
+        try:
+            # scandir already knows the type of each entry, so there is no stat per subfolder
+            with os.scandir(parent) as entries:
+                for e in entries:
+                    if e.is_dir():
+                        dirs[os.path.normcase(e.name)] = e.name
+        except OSError:
+            pass
+        listed[parent] = dirs
+        return dirs
+
+    # method to forget the executables found so far, e.g. after installing a new version of one
+    @staticmethod
+    def clear_exec_cache():
+        """Utility to clear the cached executables: the ones found with a system-wide search, and the python executable found by find_py_exe
+        """
+        _find_executable_cache.clear()
+        Executor.find_py_exe.cache_clear()
+
     # general method to find the python executable associated with the running interpreter. sys.executable is modified by ArcMap
+    # the interpreter does not move while running, so the search is done once for each w_exe value
     @staticmethod
+    @lru_cache(maxsize=2)
     def find_py_exe(w_exe=False):
         """Utility to find the python or pythonw executable in the ArcGIS environment.
 
@@ -4,34 +4,66 @@
 
 import sys
 import os
-import re
-import operator
+import atexit
+import queue
 import threading
 import warnings
+import weakref
 import datetime
 import logging
 import time
 import numpy as np
-from functools import partial
+from functools import partial, lru_cache
+from logging.handlers import QueueHandler, QueueListener
 # python 2/3 compatibility
 try:
     basestring
-    unicode
 except NameError:
     basestring = (str, bytes)
-    unicode = str
+
+
+# normalise a multiline message in a single pass
+# any line end becomes \r\n, empty lines and the leading spaces of the following lines are dropped,
+# and there is no line end at the end of the message (it will be appended by the function to emit the message)
+def _normalize(msg):
+    # most of the messages are a single line
+    if '\n' not in msg and '\r' not in msg:
+        return msg
+    lines = msg.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    following = [line for line in (l.lstrip() for l in lines[1:]) if line]
+    return '\r\n'.join([lines[0]] + following)
+
+
+# format a record with the handler formatter and normalise it, or return None if there is nothing to print
+def _format_entry(handler, record):
+    msg = handler.format(record)
+    if not msg or msg.isspace():  # to handle empty lines
+        return None
+    return _normalize(msg)
 
 
 def _stream_write(msg, stream):
     stream.write(msg + '\n')
     stream.flush()
 
+
+# the streams are looked up on every call, so redirecting sys.stdout and sys.stderr still works
+def _stdout_write(msg):
+    _stream_write(msg, sys.stdout)
+
+
+def _stderr_write(msg):
+    _stream_write(msg, sys.stderr)
+
+# the logging backend is resolved once here, the handlers call log_info, log_warning and log_error directly
+environment = None
+
 #setting up the support of xGIS
 try:
     os.environ['xGIS_child']
-    log_info = lambda msg: _stream_write(msg, sys.stdout)
-    log_warning = lambda msg: _stream_write(msg, sys.stdout)
-    log_error = lambda msg: _stream_write(msg, sys.stderr)
+    log_info = _stdout_write
+    log_warning = _stdout_write
+    log_error = _stderr_write
     environment = 'xgis'
     format = '%(message)s'
 except KeyError:
@@ -58,12 +90,10 @@ except ImportError:
     pass
 
 # fallback redirection method
-try:
-    log_info
-except NameError:
-    log_info = lambda msg: _stream_write(msg, sys.stdout)
-    log_warning = lambda msg: _stream_write(msg, sys.stdout)
-    log_error = lambda msg: _stream_write(msg, sys.stderr)
+if environment is None:
+    log_info = _stdout_write
+    log_warning = _stdout_write
+    log_error = _stderr_write
     environment = 'python'
 
 
@@ -204,14 +234,14 @@ class LogToLevel(object):
     internal_level = None
     external_level = None
     # alternative values         0             10            20               30             40                50
-    valid_levels = [logging.NOTSET, logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL]
+    valid_levels = frozenset([logging.NOTSET, logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL])
 
     # initialise the context manager, save the current logging level and the one you want
     def __init__(self, logger, level):
         if not isinstance(logger, logging.Logger):
             raise TypeError('The argument logger must be a valid logging.Logger')
         if not isinstance(level, int) or level not in self.valid_levels:
-            raise ValueError('the argument level must be a valid logging level. Accepted values are {0}'.format(self.valid_levels))
+            raise ValueError('the argument level must be a valid logging level. Accepted values are {0}'.format(sorted(self.valid_levels)))
         self.logger = logger
         self.external_level = self.logger.level
         self.internal_level = level
@@ -253,116 +283,196 @@ class ConditionalFilter(logging.Filter):
         return self.condition(record.levelno, self.level)
 
 
-# handler to redirect NOTSET, DEBUG and INFO level to arcpy.AddMessage
-class GISMessageHandler(logging.Handler):
+# formatter reusing the last timestamp, as the records logged within the same second share it
+class CachedTimeFormatter(logging.Formatter):
+    _last_time = (None, None, None, '')
+
+    def formatTime(self, record, datefmt=None):
+        # the default format includes the milliseconds, so it cannot be reused
+        if datefmt is None:
+            return logging.Formatter.formatTime(self, record, datefmt)
+        ct = int(record.created)
+        last_ct, last_datefmt, last_converter, last_str = CachedTimeFormatter._last_time
+        if ct == last_ct and datefmt == last_datefmt and self.converter == last_converter:
+            return last_str
+        time_str = time.strftime(datefmt, self.converter(ct))
+        # a single assignment, so other threads see either the old or the new entry
+        CachedTimeFormatter._last_time = (ct, datefmt, self.converter, time_str)
+        return time_str
+
+
+# the GIS handlers write to the same destination, so they share their formatters and a single lock
+_GIS_FORMATTER = CachedTimeFormatter(fmt=format, datefmt='%H:%M:%S')
+_GIS_WARNING_FORMATTER = CachedTimeFormatter(fmt='%(levelname)s ' + format, datefmt='%H:%M:%S')
+_GIS_LOCK = threading.RLock()
+
+
+# replacement for logging.Handler.handle which does not hold the lock for the whole emit
+# the handlers below format the record first, and only take the lock around the actual write
+def _handle_unlocked(self, record):
+    rv = self.filter(record)
+    if rv:
+        self.emit(record)
+    return rv
+
+
+# base handler redirecting a range of logging levels to the GIS logging backend
+# subclasses define _write(log_entry), passing the formatted entry to their backend function
+class _GISHandler(logging.Handler):
+    min_level = logging.NOTSET
+    max_level = None  # None for no upper bound
+    default_formatter = _GIS_FORMATTER
+
     def __init__(self):
-        self.filters = [ConditionalFilter(logging.INFO, operator.le)]  # handling logging.debug and logging.info
-        self.level = logging.DEBUG
+        self.filters = []
+        self.level = self.min_level
         self._name = None
-        self.formatter = logging.Formatter(fmt=format, datefmt='%H:%M:%S')
-        self.lock = threading.RLock()
+        self.formatter = self.default_formatter
+        self.lock = _GIS_LOCK
+
+    handle = _handle_unlocked
 
     def emit(self, message):
-        log_entry = self.format(message)
-        # log_entry = 'LINE' + log_entry
-        if not log_entry.strip():  # to handle empty lines
+        if self.max_level is not None and message.levelno > self.max_level:
             return
-        log_entry = re.sub('\n(?!$)', '\n' + ' ' * 16, log_entry)
-        log_entry = re.sub(r'(?:(?:\r\n|\r|\n)\s*)+', '\r\n', log_entry)  # to handle multiline with empty lines
-        log_entry = re.sub(r'(?:\r\n|\r|\n)$', '', log_entry)
-        log_info(log_entry)
-        return
+        log_entry = _format_entry(self, message)
+        if log_entry is not None:
+            self._write(log_entry)
+
+
+# handler to redirect NOTSET, DEBUG and INFO level to arcpy.AddMessage
+class GISMessageHandler(_GISHandler):
+    min_level = logging.DEBUG  # handling logging.debug and logging.info
+    max_level = logging.INFO
+
+    def _write(self, log_entry):
+        with self.lock:
+            log_info(log_entry)
 
 
 # handler to redirect WARNING level to arcpy.AddWarning
-class GISWarningHandler(logging.Handler):
-    def __init__(self):
-        self.filters = [ConditionalFilter(logging.WARN, operator.eq)]  # handling logging.warning
-        self.level = logging.WARN
-        self._name = None
-        self.formatter = logging.Formatter(fmt= '%(levelname)s '+format, datefmt='%H:%M:%S')
-        self.lock = threading.RLock()
+class GISWarningHandler(_GISHandler):
+    min_level = logging.WARN  # handling logging.warning
+    max_level = logging.WARN
+    default_formatter = _GIS_WARNING_FORMATTER
 
-    def emit(self, message):
-        log_entry = self.format(message)
-        if not log_entry.strip():
-            return
-        log_entry = re.sub('\n(?!$)', '\n' + ' ' * 16, log_entry)
-        log_entry = re.sub(r'(?:(?:\r\n|\r|\n)\s*)+', '\r\n', log_entry)  # to handle multiline with empty lines
-        log_entry = re.sub(r'(?:\r\n|\r|\n)$', '', log_entry)  # to suppress the last new line (will be appended by the function to emit the message)
-        log_warning(log_entry)
-        # warnings is too messy
-        # warnings.warn(log_entry + '\n')  # This is not retrieved by ArcMAP, but handled properly by python
-        return
+    def _write(self, log_entry):
+        # the warnings module is not used here, as ArcMAP does not retrieve it and it walks the stack on every call
+        with self.lock:
+            log_warning(log_entry)
 
 
 # handler to redirect ERROR and CRITICAL level to arcpy.AddError
 # please note that ArcMAP will exit once the first call to arcpy.AddError is finished
 # however you can pass a multiline string to it
-class GISErrorHandler(logging.Handler):
-    def __init__(self):
-        self.filters = [ConditionalFilter(logging.ERROR, operator.ge)]  # handling logging.error, logging.critical and logging.exception
-        self.level = logging.ERROR
-        self._name = None
-        self.formatter = logging.Formatter(fmt=format, datefmt='%H:%M:%S')
-        self.lock = threading.RLock()
-
-    def emit(self, message):
-        log_entry = self.format(message)
-        if not log_entry.strip():
-            return
-        log_entry = re.sub('\n(?!$)', '\n' + ' ' * 16, log_entry)
-        log_entry = re.sub(r'(?:(?:\r\n|\r|\n)\s*)+', '\r\n', log_entry)  # to handle multiline with empty lines
-        log_entry = re.sub(r'(?:\r\n|\r|\n)$', '', log_entry)  # to suppress the last new line (will be appended by the function to emit the message)
-        log_error(log_entry)
+class GISErrorHandler(_GISHandler):
+    min_level = logging.ERROR  # handling logging.error, logging.critical and logging.exception
+    max_level = None  # and any custom level above them
+
+    def _write(self, log_entry):
+        # ArcMAP may exit once AddError is finished, so write out the buffered log files first
+        _flush_log_files()
+        with self.lock:
+            log_error(log_entry)
         # sys.exit(1)  # Kill the process
 
 
+# log files currently open, so they can be flushed before reporting an error
+_open_log_files = weakref.WeakSet()
+
+
+def _flush_log_files():
+    for h in list(_open_log_files):
+        h.flush()
+
+
 # handler for log file
+# the encoded records are collected in a buffer and appended to the file with a single write
+# when the buffer is full, on errors, every flush_interval seconds and on close
+# buffer_size and flush_interval can be passed to the constructor, a buffer_size of 0 writes every record straight away
 class ARCFileHandler(logging.FileHandler):
+    buffer_size = 64 * 1024
+    flush_interval = 30
+    terminator = os.linesep.encode('ascii')
+    _flush_timer = None
+
+    def __init__(self, filename, mode='a', encoding='utf-8', delay=False, buffer_size=None, flush_interval=None):
+        if buffer_size is not None:
+            self.buffer_size = buffer_size
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        self._buffer = bytearray()
+        logging.FileHandler.__init__(self, filename, mode=mode, encoding=encoding or 'utf-8', delay=delay)
+        _open_log_files.add(self)
+        # a flush_interval of 0 disables the periodic flush
+        if self.flush_interval:
+            self._schedule_flush()
+
+    # the file is always opened unbuffered in append mode, as the handler does its own buffering
+    def _open(self):
+        return open(self.baseFilename, 'ab', buffering=0)
+
+    def flush(self):
+        with self.lock:
+            buf = self._buffer
+            if not buf:
+                return
+            if self.stream is None:
+                self.stream = self._open()
+            while buf:
+                written = self.stream.write(buf)
+                del buf[:written]
+
+    # flush in the background so a quiet session still gets its records on disk
+    def _schedule_flush(self):
+        self._flush_timer = threading.Timer(self.flush_interval, self._periodic_flush)
+        self._flush_timer.daemon = True
+        self._flush_timer.start()
+
+    def _periodic_flush(self):
+        self.flush()
+        with self.lock:
+            if self._flush_timer is not None:
+                self._schedule_flush()
+
+    def close(self):
+        with self.lock:
+            timer = self._flush_timer
+            self._flush_timer = None
+        if timer is not None:
+            timer.cancel()
+        _open_log_files.discard(self)
+        logging.FileHandler.close(self)
+
+    # write some text as it is, bypassing the formatter. It is buffered like the records, so the order is kept
+    def write_raw(self, text):
+        data = text.replace('\n', os.linesep).encode(self.encoding, 'replace')
+        with self.lock:
+            self._buffer += data
+
+    handle = _handle_unlocked
+
     # safe emit method with fallback
     def emit(self, message):
         try:
-            msg = self.format(message)
+            msg = _format_entry(self, message)
             # if the line is empty, return
-            if not msg.strip():
+            if msg is None:
                 return
-            # otherwise, re-format it
-            msg = msg.replace('\n', '\n' + ' ' * 16)  # to handle multiline. This will offset any line after the first to print empty space belog the LEVEL: HH:MM:SS of the first line
-            msg = re.sub(r'(?:(?:\r\n|\r|\n)\s*)+', '\r\n', msg)  # to handle multiline with empty lines
-            msg = re.sub(r'(?:\r\n|\r|\n)$', '', msg)  # to handle multiline with multiple line ends
-            # msg = msg.replace('\r', '')  # To remove extra carriage returns, assuming that end of line will be \r\n
-            stream = self.stream
-            fs = "%s\n"
-            if not logging._unicode:  # if no unicode support...
-                stream.write(fs % msg)
-            else:
-                try:
-                    if (isinstance(msg, unicode) and getattr(stream, 'encoding', None)):
-                        ufs = u'%s\n'
-                        try:
-                            stream.write(ufs % msg)
-                        except UnicodeEncodeError:
-                            # Printing to terminals sometimes fails. For example,
-                            # with an encoding of 'cp1251', the above write will
-                            # work if written to a stream opened or wrapped by
-                            # the codecs module, but fail when writing to a
-                            # terminal even when the codepage is set to cp1251.
-                            # An extra encoding step seems to be needed.
-                            stream.write((ufs % msg).encode(stream.encoding))
-                    else:
-                        stream.write(fs % msg)
-                except UnicodeError:
-                    stream.write(fs % msg.encode("UTF-8"))
-            self.flush()
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except:
+            data = msg.encode(self.encoding, 'replace')
+            with self.lock:
+                buf = self._buffer
+                buf += data
+                buf += self.terminator
+                # errors are written straight away, as ArcMAP may exit right after reporting them
+                if len(buf) >= self.buffer_size or message.levelno >= logging.ERROR:
+                    self.flush()
+        except Exception:
             self.handleError(message)
 
 
 # method to initialise the module logger, or another one passed with the first argument
-def initialise_logger(i_logger=False, to_file=False, force=True, level=logging.INFO):
+def initialise_logger(i_logger=False, to_file=False, force=True, level=logging.INFO, background=False):
     """method to initialise a new logger, or re-initialise an already existing one
 
     Arguments:
@@ -384,6 +494,9 @@ def initialise_logger(i_logger=False, to_file=False, force=True, level=logging.I
         to force reinitialisation of this logger. It will delete any handler associated with this logger
     level : logging.Level, optional (default : logging.INFO)\n
         logging level to use for the logger
+    background : bool, optional (default : False)\n
+        if True, the logger will only put the records on a queue, and the handlers will format and emit them from a background thread.
+        Keep it False when the messages must reach ArcGIS from the geoprocessing thread
 
     Returns:
     -----------
@@ -396,69 +509,105 @@ def initialise_logger(i_logger=False, to_file=False, force=True, level=logging.I
     elif not isinstance(i_logger, logging.Logger):
         raise TypeError("The argument 'i_logger' must be a logging.Logger or False")
 
-    # if the logger does not have any handler, initialise it
-    if len(i_logger.handlers) == 0:
+    # the logger was already initialised, and we do not want to re-initialise it
+    if i_logger.handlers and not force:
+        log_warning("The logger is already initialised. Please rerun this function with force=True")
+    # otherwise (re)initialise it
+    else:
+        # stop the background listener, if any, so the queued records are emitted first
+        _stop_listener(i_logger)
+        # then drop and close all the current handlers in one go, releasing any log file
+        old_handlers = list(i_logger.handlers)
+        i_logger.handlers.clear()
+        for h in old_handlers:
+            h.close()
+
         # if we want to log to disk
         i_logger.setLevel(level)
+        handlers = []
         if to_file is True or isinstance(to_file, basestring):
-            filename = _get_log_filename(to_file)
-            i_logger = _log_to_file(i_logger, filename, level)
+            # the filename and the banner share the same timestamp, so they agree even around midnight
+            now = datetime.datetime.today()
+            filename = _get_log_filename(to_file, now)
+            handlers.append(_log_to_file(filename, level, now))
 
         # initialise the logger with the other handlers
-        i_logger.addHandler(GISMessageHandler())
-        i_logger.addHandler(GISErrorHandler())
-        i_logger.addHandler(GISWarningHandler())
+        handlers.extend([GISMessageHandler(), GISErrorHandler(), GISWarningHandler()])
+        if background:
+            # the logger only enqueues the records, a listener thread will pass them to the handlers
+            log_queue = queue.Queue(-1)
+            listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+            i_logger._listener = listener
+            i_logger.addHandler(QueueHandler(log_queue))
+        else:
+            for h in handlers:
+                i_logger.addHandler(h)
         i_logger.setLevel(level)
         warnings.showwarning = partial(_showwarning, i_logger)
 
-    # the logger was already initialised
-    else:
-        # do we want to re-initialise it?
-        if force:
-            # then remove all the current handlers
-            while len(i_logger.handlers) > 0:
-                h = i_logger.handlers[0]
-                i_logger.removeHandler(h)
-            # and call again this method with the clean  logger
-            i_logger = initialise_logger(i_logger=i_logger, to_file=to_file, force=False, level=level)
-        else:
-            log_warning("The logger is already initialised. Please rerun this function with force=True")
     i_logger.environment = environment
     i_logger.info("Logging environment is {0}".format(logger.environment))
     return i_logger
 
 
-# internal method to initialise the log file
-def _log_to_file(i_logger, filename, level):
-    # open the file for the first time in this session
-    with open(filename, mode='a+') as log:
-        # if we are running a background geoprocessing
-        if sys.executable.endswith('RuntimeLocalServer.exe'):
-            timestamp = datetime.datetime.today().strftime("%H:%M:%S")
-            log.write('{:8s}: {:15s} Initializing background geoprocessing\n'.format('INFO', timestamp))
-        # if we are running from a front end process
-        else:
-            timestamp = datetime.datetime.today().strftime("%Y-%m-%d %H:%M")
-            log.write('********************************************************\n')
-            log.write('* Logging started on {0:16} in {1:8s} mode *\n'.format(timestamp, logging.getLevelName(level)))
-            log.write('********************************************************\n')
+# internal method to stop and drop the background listener of a logger
+def _stop_listener(i_logger):
+    listener = getattr(i_logger, '_listener', None)
+    if listener is None:
+        return
+    atexit.unregister(listener.stop)
+    listener.stop()
+    for h in listener.handlers:
+        h.close()
+    i_logger._listener = None
+
 
+# internal method to initialise the log file
+def _log_to_file(filename, level, now=None):
+    if now is None:
+        now = datetime.datetime.today()
     # hook the log file to the file handler
     handler = ARCFileHandler(filename, mode='a+')
-    handler.setFormatter(logging.Formatter(fmt='%(levelname)-8s: %(asctime)-15s %(message)s', datefmt='%H:%M:%S'))
-    i_logger.addHandler(handler)
-    return i_logger
+    handler.setFormatter(CachedTimeFormatter(fmt='%(levelname)-8s: %(asctime)-15s %(message)s', datefmt='%H:%M:%S'))
+
+    # and start this session with a banner
+    # if we are running a background geoprocessing
+    if sys.executable.endswith('RuntimeLocalServer.exe'):
+        timestamp = now.strftime("%H:%M:%S")
+        handler.write_raw('{:8s}: {:15s} Initializing background geoprocessing\n'.format('INFO', timestamp))
+    # if we are running from a front end process
+    else:
+        timestamp = now.strftime("%Y-%m-%d %H:%M")
+        handler.write_raw('********************************************************\n'
+                          '* Logging started on {0:16} in {1:8s} mode *\n'
+                          '********************************************************\n'.format(timestamp, logging.getLevelName(level)))
+    return handler
+
+
+# the user home and name do not change within a session
+_HOME = os.path.expanduser("~")
+_USERNAME = os.path.basename(_HOME)
+
+
+# date used in the log filenames, only formatted again when the day changes
+@lru_cache(maxsize=1)
+def _date_str(ordinal):
+    return datetime.date.fromordinal(ordinal).strftime("%Y%m%d")
 
 
 # internal method to interpret the to_file argument
-def _get_log_filename(to_file):
+def _get_log_filename(to_file, now=None):
+    if now is None:
+        now = datetime.datetime.today()
     # default path
-    home = os.path.expanduser("~")
+    home = _HOME
     default_path = os.path.join(home, 'ArcLogger_logs')
 
     # default filename
-    username = os.path.split(home)[-1]
-    date_str = datetime.datetime.today().strftime("%Y%m%d")
+    username = _USERNAME
+    date_str = _date_str(now.toordinal())
     default_filename = '_'.join(['ArcLogger', username, date_str]) + '.log'
 
     if to_file is True:
@@ -484,8 +633,8 @@ def _get_log_filename(to_file):
         raise TypeError('The argument must be True or a string')
 
     # if the folder does not exist, make it
-    if not os.path.isdir(path) and not path == '':
-        os.makedirs(path)
+    if path:
+        os.makedirs(path, exist_ok=True)
     # return path_to_file
     return os.path.join(path, filename)
 